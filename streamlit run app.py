@@ -1,13 +1,26 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import altair as alt
+from matplotlib import rcParams
+from matplotlib.figure import Figure
 from scipy.signal import find_peaks
+from numba import njit
 import io
+import json
+import hashlib
+import xxhash
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final
 
 st.set_page_config(layout="wide")
 
 # === Farbauswahl (erweiterte Heatmap) ===
-color_palette = {
+COLOR_PALETTE: Final = {
     "Dark Blue": "#2066a8",
     "Med Blue": "#8ecdda",
     "Light Blue": "#cde1ec",
@@ -23,124 +36,509 @@ color_palette = {
     "Strong Orange": "#e34a33",
     "Black (Default)": "#000000"
 }
+PALETTE_NAMES: Final = tuple(COLOR_PALETTE.keys())
+PALETTE_COLORS: Final = tuple(COLOR_PALETTE.values())
+
+LEGEND_POSITIONS: Final = (
+    "best", "upper right", "upper left", "lower left", "lower right",
+    "right", "center left", "center right", "lower center", "upper center", "center"
+)
+# Matplotlib-Legendenposition -> Vega-Lite legend orient (Vorschau)
+LEGEND_ORIENT: Final = {
+    "best": "bottom-left", "upper right": "top-right", "upper left": "top-left",
+    "lower left": "bottom-left", "lower right": "bottom-right", "right": "right",
+    "center left": "left", "center right": "right", "lower center": "bottom",
+    "upper center": "top", "center": "top-right"
+}
 
 # === Hilfsfunktionen ===
 
-def load_data(file):
+# Spektrum als Struct-of-Arrays: zwei parallele float32-Arrays, aufsteigend nach Wellenzahl,
+# plus ein Inhalts-Hash der Datei als günstiger Cache-Schlüssel
+SpectrumSoA = namedtuple("SpectrumSoA", "wavenumber transmission key")
+
+# Anzahl der markierten Peaks je Spektrum (fest, dafür werden die Artists vorab angelegt)
+PEAK_TOP_N = 10
+
+# Höchstzahl gemerkter Peak-Ergebnisse (Datei, Bereich) je Session
+PEAK_MEMO_SIZE = 64
+
+# Auflösung des PNG-Exports; die Session-Figure wird nur dafür gezeichnet
+EXPORT_DPI = 300
+
+# Gefundene Peaks: Wellenzahl (abgeschnitten auf int) und auf 2 Stellen gerundete Transmission
+PEAK_DTYPE = np.dtype([("wn", np.int32), ("t", np.float64)])
+
+# CSV-Format: eine Kopfzeile, dann "Wellenzahl;Transmission"
+# Blöcke zu 1 MiB: große Dateien werden stückweise geparst, kleine bleiben ein einziger Block
+CSV_READ_OPTIONS = pacsv.ReadOptions(skip_rows=1, column_names=["Wavenumber_cm_1", "Transmission"], block_size=1 << 20)
+CSV_PARSE_OPTIONS = pacsv.ParseOptions(delimiter=';')
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    column_types={"Wavenumber_cm_1": pa.float32(), "Transmission": pa.float32()},
+    null_values=["", "NA"],
+    strings_can_be_null=True
+)
+# Gleiches Schema für Exporte mit Dezimalkomma (z.B. "1234,5;87,3")
+CSV_CONVERT_OPTIONS_DECIMAL_COMMA = pacsv.ConvertOptions(
+    column_types={"Wavenumber_cm_1": pa.float32(), "Transmission": pa.float32()},
+    null_values=["", "NA"],
+    strings_can_be_null=True,
+    decimal_point=','
+)
+
+def _read_csv_columns(raw, convert_options):
+    # Blockweise lesen: pro Block nur die gültigen Zeilen behalten, statt die ganze Tabelle zu materialisieren.
+    # BufferReader liest nativ und ohne Kopie aus den Bytes, ohne Umweg über ein Python-Dateiobjekt (und den GIL)
+    reader = pacsv.open_csv(pa.BufferReader(raw), read_options=CSV_READ_OPTIONS, parse_options=CSV_PARSE_OPTIONS, convert_options=convert_options)
+    wn_chunks, tr_chunks = [], []
+    for batch in reader:
+        wn = batch.column(0).to_numpy(zero_copy_only=False)
+        tr = batch.column(1).to_numpy(zero_copy_only=False)
+        valid = ~(np.isnan(wn) | np.isnan(tr))
+        wn_chunks.append(wn[valid])
+        tr_chunks.append(tr[valid])
+    wn = np.concatenate(wn_chunks) if wn_chunks else np.empty(0, dtype=np.float32)
+    tr = np.concatenate(tr_chunks) if tr_chunks else np.empty(0, dtype=np.float32)
+    return wn, tr
+
+def _read_csv_columns_lenient(raw):
+    # Toleranter Weg wie ursprünglich mit pandas: nicht lesbare Werte (Fußzeile, "n.a.", zweite Kopfzeile)
+    # werden zu NaN und ihre Zeilen verworfen, statt die ganze Datei abzulehnen. Dezimalkomma wird mit akzeptiert.
+    df = pd.read_csv(io.BytesIO(raw), skiprows=1, sep=';', names=CSV_READ_OPTIONS.column_names, dtype=str, on_bad_lines='skip')
+    wn = pd.to_numeric(df["Wavenumber_cm_1"].str.replace(',', '.', regex=False), errors='coerce').to_numpy(dtype=np.float32)
+    tr = pd.to_numeric(df["Transmission"].str.replace(',', '.', regex=False), errors='coerce').to_numpy(dtype=np.float32)
+    valid = ~(np.isnan(wn) | np.isnan(tr))
+    return wn[valid], tr[valid]
+
+def _read_spectrum_columns(raw):
     try:
-        df = pd.read_csv(file, skiprows=1, sep=';', names=["Wavenumber_cm_1", "Transmission"])
-        df = df.dropna()
-        df["Wavenumber_cm_1"] = pd.to_numeric(df["Wavenumber_cm_1"], errors='coerce')
-        df["Transmission"] = pd.to_numeric(df["Transmission"], errors='coerce')
-        return df.dropna()
-    except Exception as e:
-        st.error(f"Fehler beim Laden der Datei {file.name}: {e}")
-        return None
+        return _read_csv_columns(raw, CSV_CONVERT_OPTIONS)
+    except pa.ArrowInvalid as first:
+        # Dezimalkomma kann nur Konvertierungsfehler beheben, keine falsche Spaltenzahl
+        if "conversion error" in str(first):
+            try:
+                return _read_csv_columns(raw, CSV_CONVERT_OPTIONS_DECIMAL_COMMA)
+            except pa.ArrowInvalid:
+                pass
+        # Einzelne unlesbare Zeilen: nur diese verwerfen, der Rest der Datei wird trotzdem geladen.
+        # Scheitert auch das, wird der ursprüngliche Fehler gemeldet, nicht der eines Wiederholungsversuchs.
+        try:
+            return _read_csv_columns_lenient(raw)
+        except Exception:
+            raise first
+
+# Caches gelten prozessweit für alle Sessions: Größe und Lebensdauer begrenzen, damit der Speicher nicht mitwächst
+@st.cache_data(show_spinner=False, max_entries=64, ttl="1h")
+def _parse_csv_bytes(file_id: str, _raw: bytes) -> SpectrumSoA:
+    # Cache-Schlüssel ist nur der Inhalts-Hash file_id, die Bytes selbst werden nicht noch einmal gehasht
+    wn, tr = _read_spectrum_columns(_raw)
+    # Aufsteigend nach Wellenzahl sortieren, damit Bereiche per Binärsuche geschnitten werden können
+    order = np.argsort(wn, kind="stable")
+    return SpectrumSoA(
+        np.ascontiguousarray(wn[order], dtype=np.float32),
+        np.ascontiguousarray(tr[order], dtype=np.float32),
+        file_id
+    )
+
+def load_data(files):
+    # Der Inhalts-Hash wird einmal pro Upload berechnet und dient allen Caches als Schlüssel.
+    # Schon in dieser Session geparste Dateien kommen direkt aus session_state; nur neue Dateien werden
+    # parallel geparst (pyarrow gibt beim Parsen den GIL frei). Fehler im Haupt-Thread melden.
+    parsed = st.session_state.setdefault("parsed_spectra", {})
+    raws = [file.getvalue() for file in files]
+    file_ids = [xxhash.xxh3_128_hexdigest(raw) for raw in raws]
+    misses = {file_id: raw for file_id, raw in zip(file_ids, raws) if file_id not in parsed}
+    errors = {}
+    if misses:
+        with ThreadPoolExecutor(max_workers=min(8, len(misses))) as ex:
+            futures = {file_id: ex.submit(_parse_csv_bytes, file_id, raw) for file_id, raw in misses.items()}
+        for file_id, future in futures.items():
+            try:
+                parsed[file_id] = future.result()
+            except Exception as e:
+                errors[file_id] = e
+    # Nur die aktuell hochgeladenen Dateien in der Session behalten
+    st.session_state.parsed_spectra = {file_id: parsed[file_id] for file_id in file_ids if file_id in parsed}
+    spectra = []
+    for file, file_id in zip(files, file_ids):
+        if file_id in errors:
+            st.error(f"Fehler beim Laden der Datei {file.name}: {errors[file_id]}")
+            spectra.append(None)
+        else:
+            spectra.append(parsed[file_id])
+    return spectra
+
+# Feste Signaturen: kompiliert wird beim Import (bzw. aus dem Cache geladen), nicht beim ersten Rerun.
+# y ist zusammenhängend ([::1]) oder eine umgedrehte Sicht ([:]).
+@njit(["float32[:](float32[::1])", "float32[:](float32[:])"], nogil=True, cache=True)
+def base_max_left(y):
+    # Für jeden Punkt i: Maximum von y zwischen dem nächsten tieferen Punkt links (exklusiv) und i.
+    # Monotoner Stack, dadurch O(n) insgesamt statt eines eigenen Laufs pro Peak.
+    n = y.size
+    out = np.empty(n, dtype=y.dtype)
+    stack_val = np.empty(n, dtype=y.dtype)
+    stack_max = np.empty(n, dtype=y.dtype)
+    top = 0
+    for i in range(n):
+        cur = y[i]
+        while top > 0 and stack_val[top - 1] >= y[i]:
+            top -= 1
+            if stack_max[top] > cur:
+                cur = stack_max[top]
+        out[i] = cur
+        stack_val[top] = y[i]
+        stack_max[top] = cur
+        top += 1
+    return out
+
+@njit("(float32[::1], float64)", nogil=True, cache=True)
+def find_negative_peaks(y, prominence):
+    # Lokale Minima mit Prominenz wie scipy.signal.find_peaks(-y, prominence=...), aber ohne negierte Kopie von y
+    n = y.size
+    idx = np.empty(n // 2, dtype=np.int64)
+    prom = np.empty(n // 2, dtype=np.float64)
+    # Basis links/rechts: höchster Wert, bevor ein tieferer Punkt als der Peak erreicht wird
+    left_max = base_max_left(y)
+    right_max = base_max_left(y[::-1])[::-1]
+    count = 0
+    i = 1
+    while i < n - 1:
+        if y[i - 1] > y[i]:
+            # Flache Minima (Plateaus) zählen einmal, an ihrer Mitte
+            i_ahead = i + 1
+            while i_ahead < n - 1 and y[i_ahead] == y[i]:
+                i_ahead += 1
+            if y[i_ahead] > y[i]:
+                peak = (i + i_ahead - 1) // 2
+                p = np.float64(min(left_max[peak], right_max[peak])) - np.float64(y[peak])
+                if p >= prominence:
+                    idx[count] = peak
+                    prom[count] = p
+                    count += 1
+                i = i_ahead
+        i += 1
+    return idx[:count], prom[:count]
 
 def get_negative_peaks(x, y, prominence=0.1, top_n=10):
-    peaks = []
-    neg_peaks, props = find_peaks(-y, prominence=prominence)
-    sorted_peaks = sorted(zip(neg_peaks, props["prominences"]), key=lambda t: t[1], reverse=True)[:top_n]
-    for idx, _ in sorted_peaks:
-        peaks.append(("Negativ", int(x[idx]), round(y[idx], 2)))
+    try:
+        neg_peaks, prom = find_negative_peaks(y, prominence)
+    except TypeError:
+        # Nur für Eingaben, die zu keiner kompilierten Signatur passen (anderer dtype/Layout)
+        neg_peaks, props = find_peaks(-y, prominence=prominence)
+        prom = props["prominences"]
+    k = min(top_n, prom.size)
+    if k == 0:
+        return np.empty(0, dtype=PEAK_DTYPE)
+    # Nur die k prominentesten Peaks auswählen und sortieren
+    top = np.argpartition(prom, prom.size - k)[-k:]
+    top = top[np.argsort(-prom[top], kind="stable")]
+    idxs = neg_peaks[top]
+    peaks = np.empty(k, dtype=PEAK_DTYPE)
+    peaks["wn"] = x[idxs]
+    peaks["t"] = np.round(y[idxs].astype(np.float64), 2)
     return peaks
 
-def annotate_negative_peaks(ax, x, y, prominence=0.1, top_n=10, color='blue'):
-    peaks = get_negative_peaks(x, y, prominence, top_n)
-    for typ, wn, intensity in peaks:
-        ax.plot(wn, intensity, marker='o', color=color)
-        ax.text(wn, intensity, f"{wn}", fontsize=9, ha='center', va='top', color=color)
+@st.cache_data(show_spinner=False, max_entries=512, ttl="1h")
+def get_cached_negative_peaks(spectrum_key, x_range, _x, _y, prominence=0.1, top_n=10):
+    # Schlüssel sind nur Datei-Hash und Bereich; die Arrays selbst (_x, _y) werden nicht gehasht
+    return get_negative_peaks(_x, _y, prominence, top_n)
+
+def downsample_minmax(x, y, max_points):
+    # Min/Max-Binning: je Bin (~1 Pixelspalte) bleiben Minimum und Maximum in Originalreihenfolge erhalten,
+    # dadurch sieht die reduzierte Linie pixelgenau wie die volle aus (inkl. Peak-Spitzen)
+    n_bins = max_points // 2
+    bin_size = -(-x.size // n_bins)
+    n_bins = -(-x.size // bin_size)
+    padded = np.pad(y, (0, n_bins * bin_size - y.size), mode='edge').reshape(n_bins, bin_size)
+    offsets = np.arange(n_bins) * bin_size
+    i_min = offsets + padded.argmin(axis=1)
+    i_max = offsets + padded.argmax(axis=1)
+    idx = np.minimum(np.sort(np.column_stack((i_min, i_max)), axis=1).ravel(), x.size - 1)
+    return x[idx], y[idx]
 
-def plot_spectra(dfs, settings, show_peaks, x_range, font_size, legend_pos, line_width):
-    fig, ax = plt.subplots(figsize=(10, 6))
+def create_peak_pool(ax):
+    # Ein Scatter für alle Marker und PEAK_TOP_N Beschriftungen je Spektrum, einmal angelegt und danach nur aktualisiert
+    return {
+        "dots": ax.scatter([], [], s=36, zorder=3),
+        "texts": [ax.text(0, 0, "", fontsize=9, ha='center', va='top', visible=False) for _ in range(PEAK_TOP_N)]
+    }
+
+def annotate_negative_peaks(pool, peaks, color, zorder=3):
+    pool["dots"].set_offsets(np.column_stack((peaks["wn"], peaks["t"])))
+    pool["dots"].set_color(color)
+    pool["dots"].set_zorder(zorder)
+    for i, txt in enumerate(pool["texts"]):
+        if i < peaks.size:
+            wn = int(peaks["wn"][i])
+            txt.set_position((wn, peaks["t"][i]))
+            txt.set_text(f"{wn:d}")
+            txt.set_color(color)
+            txt.set_zorder(zorder)
+            txt.set_visible(True)
+        else:
+            txt.set_visible(False)
+
+def remove_peak_pool(pool):
+    pool["dots"].remove()
+    for txt in pool["texts"]:
+        txt.remove()
+
+def get_plot_state():
+    # Figure, Achse und Linien bleiben über Reruns hinweg in der Session erhalten
+    if "fig" not in st.session_state:
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
+        ax.invert_xaxis()
+        st.session_state.fig = fig
+        st.session_state.ax = ax
+        st.session_state.lines = {}
+        st.session_state.peak_pools = {}
+    return st.session_state.fig, st.session_state.ax, st.session_state.lines, st.session_state.peak_pools
+
+def get_fig_lock():
+    # Die Session-Figure wird auch im Download-Thread gerendert; Ändern und Rendern nur unter diesem Lock
+    if "fig_lock" not in st.session_state:
+        st.session_state.fig_lock = threading.Lock()
+    return st.session_state.fig_lock
+
+def slice_range(wn, tr, x_range):
+    # Wellenzahlen sind aufsteigend sortiert: Bereich per Binärsuche, Ergebnis sind Views
     start_x, end_x = x_range
+    lo = np.searchsorted(wn, end_x, side='left')
+    hi = np.searchsorted(wn, start_x, side='right')
+    return wn[lo:hi], tr[lo:hi]
 
-    for name, df in dfs.items():
-        if df is None or df.empty:
+def collect_peaks(spectra, x_range):
+    # Peaks je Spektrum im Bereich x_range (None = ganzes Spektrum), einmal pro Rerun.
+    # Schon in dieser Session ermittelte Peaks kommen direkt aus session_state; nur die übrigen laufen
+    # parallel (der Numba-Kernel gibt den GIL frei).
+    memo = st.session_state.setdefault("peak_memo", {})
+    peaks_by_name, jobs = {}, {}
+    for name, (wn, tr, key) in spectra.items():
+        if (key, x_range) in memo:
+            # Treffer ans Ende rücken, damit beim Begrenzen die am längsten unbenutzten Einträge fallen
+            memo[(key, x_range)] = memo.pop((key, x_range))
+            peaks_by_name[name] = memo[(key, x_range)]
             continue
-        df_range = df[(df["Wavenumber_cm_1"] <= start_x) & (df["Wavenumber_cm_1"] >= end_x)]
-        if df_range.empty:
-            st.warning(f"Keine Daten im Bereich {end_x}–{start_x} für `{name}`")
+        x, y = slice_range(wn, tr, x_range) if x_range is not None else (wn, tr)
+        if x.size > 0:
+            jobs[name] = (key, x, y)
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(8, len(jobs))) as ex:
+            futures = {
+                name: ex.submit(get_cached_negative_peaks, key, x_range, x, y, top_n=PEAK_TOP_N)
+                for name, (key, x, y) in jobs.items()
+            }
+        for name, future in futures.items():
+            peaks_by_name[name] = memo[(jobs[name][0], x_range)] = future.result()
+        for stale in list(memo)[:-PEAK_MEMO_SIZE]:
+            del memo[stale]
+    return {name: peaks_by_name[name] for name in spectra if name in peaks_by_name}
+
+def plot_spectra(spectra, settings, peaks_by_name, x_range, font_size, legend_pos, line_width):
+    fig, ax, lines, peak_pools = get_plot_state()
+    no_peaks = np.empty(0, dtype=PEAK_DTYPE)
+    # Die Figure wird nur als PNG mit EXPORT_DPI exportiert: mehr als ~2 Punkte pro Pixel Bildbreite sind dort nicht sichtbar
+    max_points = 2 * int(fig.get_figwidth() * EXPORT_DPI)
+
+    for name in list(lines):
+        if name not in spectra:
+            lines.pop(name).remove()
+    for name in list(peak_pools):
+        if name not in spectra:
+            remove_peak_pool(peak_pools.pop(name))
+
+    # Zeichenreihenfolge fest nach Upload-Reihenfolge (zorder), nicht danach, wann ein Artist angelegt wurde:
+    # gleiche Eingaben ergeben so immer das gleiche Bild, unabhängig vom Verlauf der Session
+    for i, (name, (wn, tr, key)) in enumerate(spectra.items()):
+        z = i / len(spectra)
+        x, y = slice_range(wn, tr, x_range)
+        if x.size == 0:
+            # Linie nur ausblenden statt entfernen, damit sie ihren Platz in der Reihenfolge behält
+            if name in lines:
+                lines[name].set_visible(False)
+            if name in peak_pools:
+                annotate_negative_peaks(peak_pools[name], no_peaks, "none", 3 + z)
             continue
         color = settings[name]["color"]
         label = settings[name]["label"]
-        ax.plot(df_range["Wavenumber_cm_1"], df_range["Transmission"], label=label, color=color, linewidth=line_width)
-        if show_peaks:
-            annotate_negative_peaks(ax, df_range["Wavenumber_cm_1"].values, df_range["Transmission"].values, top_n=10, color=color)
+        # Nur die angezeigte Linie wird reduziert, die Peak-Suche nutzt alle Punkte
+        x_plot, y_plot = downsample_minmax(x, y, max_points) if x.size > max_points else (x, y)
+        if name in lines:
+            line = lines[name]
+            line.set_data(x_plot, y_plot)
+        else:
+            line, = ax.plot(x_plot, y_plot)
+            lines[name] = line
+        line.set_color(color)
+        line.set_linewidth(line_width)
+        line.set_label(label)
+        line.set_zorder(2 + z)
+        line.set_visible(True)
+        if name in peaks_by_name:
+            if name not in peak_pools:
+                peak_pools[name] = create_peak_pool(ax)
+            annotate_negative_peaks(peak_pools[name], peaks_by_name[name], color, 3 + z)
+        elif name in peak_pools:
+            annotate_negative_peaks(peak_pools[name], no_peaks, color, 3 + z)
 
-    ax.invert_xaxis()
+    ax.relim(visible_only=True)
+    ax.autoscale_view()
+    if not any(line.get_visible() for line in lines.values()):
+        # Ohne sichtbare Daten würde Autoscale die alten Grenzen behalten; stattdessen fest auf den Bereich setzen
+        ax.set_xlim(max(x_range), min(x_range), auto=None)
+        ax.set_ylim(0, 100, auto=None)
     ax.set_xlabel("Wavenumber (cm⁻¹)", fontsize=font_size)
     ax.set_ylabel("Transmission (%T)", fontsize=font_size)
     ax.tick_params(axis='both', labelsize=font_size)
-    ax.legend(loc=legend_pos, fontsize=font_size)
-    plt.tight_layout()
+    # Legende immer in Upload-Reihenfolge, unabhängig davon, wann eine Linie angelegt wurde
+    handles = [lines[name] for name in spectra if name in lines and lines[name].get_visible()]
+    ax.legend(handles=handles, loc=legend_pos, fontsize=font_size)
+    # tight_layout rechnet von der aktuellen Lage aus: erst auf die Standardränder zurücksetzen,
+    # sonst hängt das Layout von früheren Reruns ab
+    fig.subplots_adjust(**{side: rcParams[f"figure.subplot.{side}"] for side in ("left", "right", "bottom", "top")})
+    fig.tight_layout()
     return fig
 
-# === Streamlit App ===
+def spectra_chart(spectra, settings, peaks_by_name, x_range, font_size, legend_pos, line_width, max_points=2000):
+    # Interaktive Vorschau, die im Browser gerendert wird: Zoom/Pan ohne Server-Rasterung
+    start_x, end_x = x_range
+    line_parts, peak_parts = [], []
+    empty_names = []
+    for name, (wn, tr, key) in spectra.items():
+        x, y = slice_range(wn, tr, x_range)
+        if x.size == 0:
+            if wn.size > 0:
+                empty_names.append(f"`{name}`")
+            continue
+        # Gruppiert wird nach Dateiname (eindeutig), nicht nach dem frei wählbaren Label:
+        # zwei Spektren mit gleichem Label blieben sonst nicht getrennt
+        x_plot, y_plot = downsample_minmax(x, y, max_points) if x.size > max_points else (x, y)
+        line_parts.append(pd.DataFrame({"spectrum": name, "wavenumber": x_plot, "transmission": y_plot}))
+        if name in peaks_by_name:
+            peaks = peaks_by_name[name]
+            peak_parts.append(pd.DataFrame({"spectrum": name, "wavenumber": peaks["wn"], "transmission": peaks["t"]}))
 
-st.title("IR Spectrum Viewer")
+    # Eine gesammelte Warnung statt eines Elements pro Spektrum
+    if empty_names:
+        st.warning(f"Keine Daten im Bereich {end_x}–{start_x} für {', '.join(empty_names)}")
 
-uploaded_files = st.file_uploader("Lade eine oder mehrere CSV-Dateien hoch", type=["csv"], accept_multiple_files=True)
+    # Die Legende zeigt statt des Dateinamens das Label (Vega-Ausdruck: Dateiname -> Label)
+    label_expr = "(" + json.dumps({name: settings[name]["label"] for name in spectra}) + ")[datum.value]"
+    color = alt.Color(
+        "spectrum:N",
+        scale=alt.Scale(domain=list(spectra), range=[settings[name]["color"] for name in spectra]),
+        legend=alt.Legend(title=None, orient=LEGEND_ORIENT[legend_pos], labelExpr=label_expr)
+    )
+    x_enc = alt.X("wavenumber:Q", title="Wavenumber (cm⁻¹)", scale=alt.Scale(domain=[start_x, end_x]))
+    y_enc = alt.Y("transmission:Q", title="Transmission (%T)", scale=alt.Scale(zero=False))
 
-if uploaded_files:
-    dfs = {}
-    settings = {}
+    lines_df = pd.concat(line_parts, ignore_index=True) if line_parts else pd.DataFrame(columns=["spectrum", "wavenumber", "transmission"])
+    chart = alt.Chart(lines_df).mark_line(strokeWidth=line_width).encode(x=x_enc, y=y_enc, color=color)
+    if peak_parts:
+        peak_base = alt.Chart(pd.concat(peak_parts, ignore_index=True)).encode(x=x_enc, y=y_enc, color=color)
+        chart += peak_base.mark_point(filled=True, size=36, opacity=1)
+        chart += peak_base.mark_text(dy=8, baseline="top", fontSize=9).encode(text=alt.Text("wavenumber:Q", format="d"))
 
-    for i, file in enumerate(uploaded_files):
-        df = load_data(file)
-        if df is not None:
-            name = file.name
-            dfs[name] = df
-            settings[name] = {
-                "color": list(color_palette.values())[i % len(color_palette)],
-                "label": name
-            }
+    return (
+        chart.properties(height=500)
+        .interactive()
+        .configure_axis(labelFontSize=font_size, titleFontSize=font_size)
+        .configure_legend(labelFontSize=font_size)
+    )
+
+def plot_signature(spectra, settings, show_peaks, x_range, font_size, legend_pos, line_width):
+    # Hash über alle Eingaben, die das Bild verändern; Spektren gehen über ihren Inhalts-Hash ein
+    parts = (
+        tuple((name, spectrum.key, settings[name]["color"], settings[name]["label"]) for name, spectrum in spectra.items()),
+        show_peaks, tuple(x_range), font_size, legend_pos, line_width
+    )
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def render_png(signature, _fig, dpi):
+    buf = io.BytesIO()
+    _fig.savefig(buf, format="png", dpi=dpi)
+    return buf.getvalue()
 
-    st.subheader("Anzeigeeinstellungen")
-    col1, col2 = st.columns(2)
-    with col1:
-        start_x = st.number_input("Start-Wellenzahl (cm⁻¹)", min_value=600, max_value=4000, value=4000)
-    with col2:
-        end_x = st.number_input("End-Wellenzahl (cm⁻¹)", min_value=600, max_value=4000, value=600)
+def make_png_renderer(signature, fig, fig_lock):
+    # Druckqualität (EXPORT_DPI) erst rendern, wenn der Download-Button tatsächlich geklickt wird
+    def render():
+        with fig_lock:
+            return render_png(signature, fig, EXPORT_DPI)
+    return render
 
-    show_peaks = st.checkbox("Negative Peaks anzeigen", value=True)
-    font_size = st.slider("Schriftgröße", min_value=8, max_value=24, value=12)
-    line_width = st.slider("Liniendicke", min_value=1, max_value=5, value=2)
-    legend_pos = st.selectbox("Legendenposition", options=[
-        "best", "upper right", "upper left", "lower left", "lower right",
-        "right", "center left", "center right", "lower center", "upper center", "center"
-    ])
+# === Streamlit App ===
+
+@st.fragment
+def spectrum_viewer(spectra, default_settings):
+    # Widget-Änderungen führen nur dieses Fragment erneut aus, nicht das Laden der Dateien
+    settings = {name: dict(s) for name, s in default_settings.items()}
+
+    # Plot-Eingaben sammeln und erst beim Absenden übernehmen, statt bei jeder einzelnen Änderung neu zu zeichnen
+    with st.form("plot_ctrl", border=False):
+        st.subheader("Anzeigeeinstellungen")
+        col1, col2 = st.columns(2)
+        with col1:
+            start_x = st.number_input("Start-Wellenzahl (cm⁻¹)", min_value=600, max_value=4000, value=4000)
+        with col2:
+            end_x = st.number_input("End-Wellenzahl (cm⁻¹)", min_value=600, max_value=4000, value=600)
+
+        show_peaks = st.checkbox("Negative Peaks anzeigen", value=True)
+        font_size = st.slider("Schriftgröße", min_value=8, max_value=24, value=12)
+        line_width = st.slider("Liniendicke", min_value=1, max_value=5, value=2)
+        legend_pos = st.selectbox("Legendenposition", options=LEGEND_POSITIONS)
 
-    st.subheader("Einstellungen je Spektrum")
+        st.subheader("Einstellungen je Spektrum")
 
-    for name in settings:
-        st.markdown(f"**{name}**")
-        default_color = settings[name]["color"]
+        for name in settings:
+            st.markdown(f"**{name}**")
+            default_color = settings[name]["color"]
 
-        color_name = st.selectbox(
-            f"Farbwahl für `{name}`",
-            options=list(color_palette.keys()),
-            index=list(color_palette.values()).index(default_color) if default_color in color_palette.values() else 0,
-            key=f"dropdown_{name}"
-        )
+            color_name = st.selectbox(
+                f"Farbwahl für `{name}`",
+                options=PALETTE_NAMES,
+                index=PALETTE_COLORS.index(default_color) if default_color in PALETTE_COLORS else 0,
+                key=f"dropdown_{name}"
+            )
 
-        selected_color = color_palette[color_name]
+            selected_color = COLOR_PALETTE[color_name]
 
-        custom_color = st.color_picker(
-            f"Individuelle Farbe für `{name}`",
-            value=selected_color,
-            key=f"picker_{name}"
-        )
+            custom_color = st.color_picker(
+                f"Individuelle Farbe für `{name}`",
+                value=selected_color,
+                key=f"picker_{name}"
+            )
 
-        label = st.text_input(f"Legendenlabel für `{name}`", value=settings[name]["label"], key=f"label_{name}")
+            label = st.text_input(f"Legendenlabel für `{name}`", value=settings[name]["label"], key=f"label_{name}")
 
-        settings[name]["color"] = custom_color
-        settings[name]["label"] = label
+            settings[name]["color"] = custom_color
+            settings[name]["label"] = label
+
+        st.form_submit_button("Vorschau aktualisieren")
 
     st.subheader("Vorschau")
 
-    fig = plot_spectra(dfs, settings, show_peaks, (start_x, end_x), font_size, legend_pos, line_width)
-    st.pyplot(fig)
+    x_range = (start_x, end_x)
+    peaks_by_name = collect_peaks(spectra, x_range) if show_peaks else {}
+    chart = spectra_chart(spectra, settings, peaks_by_name, x_range, font_size, legend_pos, line_width)
+    st.altair_chart(chart, width="stretch", theme=None)
+
+    # Die Matplotlib-Figure dient nur dem PNG-Export: nur bei geänderten Plot-Eingaben aktualisieren,
+    # gerastert wird erst beim Download
+    fig_lock = get_fig_lock()
+    with fig_lock:
+        signature = plot_signature(spectra, settings, show_peaks, x_range, font_size, legend_pos, line_width)
+        if st.session_state.get("fig_signature") != signature:
+            plot_spectra(spectra, settings, peaks_by_name, x_range, font_size, legend_pos, line_width)
+            st.session_state.fig_signature = signature
+
+    export_section(spectra, settings, show_peaks, signature, fig_lock)
+
+@st.fragment
+def export_section(spectra, settings, show_peaks, signature, fig_lock):
+    # Eigenes Fragment: Änderungen am Dateinamen laufen nur hier, ohne Vorschau und Plot neu aufzubauen
+    fig = st.session_state.fig
 
     # === Dateiname für Export (nur einmal) ===
     st.subheader("Dateiname für Export")
@@ -148,26 +546,50 @@ if uploaded_files:
 
     # === Anzeige aller Spektren-Infos in einer Zeile ===
     st.subheader("Angezeigte Spektren")
-    info_line = " ; ".join([f"{settings[name]['label']}: {name}" for name in dfs])
+    info_line = " ; ".join([f"{settings[name]['label']}: {name}" for name in spectra])
     st.markdown(info_line)
 
     # === Exportbereich ===
     if show_peaks:
-        all_peaks = []
-        for name, df in dfs.items():
-            peaks = get_negative_peaks(df["Wavenumber_cm_1"].values, df["Transmission"].values, top_n=10)
-            for typ, wn, intensity in peaks:
-                all_peaks.append([name, typ, wn, intensity])
-        if all_peaks:
-            peaks_df = pd.DataFrame(all_peaks, columns=["Spektrum", "Peak-Typ", "Wellenzahl", "Intensität"])
-            csv = peaks_df.to_csv(index=False).encode('utf-8')
+        # Spaltenweise aus den Peak-Arrays aufbauen statt Zeile für Zeile
+        peaks_by_file = collect_peaks(spectra, None)
+        counts = [peaks.size for peaks in peaks_by_file.values()]
+        if sum(counts):
+            peaks_df = pd.DataFrame({
+                "Spektrum": np.repeat(list(peaks_by_file), counts),
+                "Peak-Typ": "Negativ",
+                "Wellenzahl": np.concatenate([peaks["wn"] for peaks in peaks_by_file.values()]),
+                "Intensität": np.concatenate([peaks["t"] for peaks in peaks_by_file.values()]),
+            })
+            csv = peaks_df.to_csv(index=False, lineterminator="\n").encode('utf-8')
             st.download_button("CSV mit Peaks herunterladen", data=csv, file_name=f"{file_base}_peaks.csv", mime="text/csv")
 
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png")
-    buf.seek(0)
-    st.download_button("Plot als PNG herunterladen", data=buf, file_name=f"{file_base}.png", mime="image/png")
+    st.download_button(
+        "Plot als PNG herunterladen",
+        data=make_png_renderer(signature, fig, fig_lock),
+        file_name=f"{file_base}.png",
+        mime="image/png",
+        on_click="ignore"
+    )
+
+st.title("IR Spectrum Viewer")
+
+uploaded_files = st.file_uploader("Lade eine oder mehrere CSV-Dateien hoch", type=["csv"], accept_multiple_files=True)
+
+if uploaded_files:
+    spectra = {}
+    settings = {}
+
+    for i, (file, spectrum) in enumerate(zip(uploaded_files, load_data(uploaded_files))):
+        if spectrum is not None:
+            name = file.name
+            spectra[name] = spectrum
+            settings[name] = {
+                "color": PALETTE_COLORS[i % len(PALETTE_COLORS)],
+                "label": name
+            }
+
+    spectrum_viewer(spectra, settings)
 
 else:
     st.info("Bitte lade mindestens eine CSV-Datei hoch.")
-